@@ -0,0 +1,188 @@
+"""
+Query budgets for MAC authentication.
+
+An opt-in mode, meant for tests and staging, that counts the database queries
+and cache calls made by each stage of Validator.validate (and so by both of
+the decorators), and complains when a stage uses more than it is allowed.
+It is turned on through the django settings:
+
+  AUTH_MAC_QUERY_BUDGET         -- True to use DEFAULT_BUDGET, or a dictionary
+                                   of stage name to maximum query count
+  AUTH_MAC_CACHE_BUDGET         -- A dictionary of stage name to maximum cache
+                                   calls. Defaults to DEFAULT_CACHE_BUDGET
+  AUTH_MAC_QUERY_BUDGET_ACTION  -- "raise" (the default) to raise
+                                   QueryBudgetExceeded, or "log" to log a warning
+
+Stages missing from a budget dictionary take their default value.
+
+Only calls to the default cache are counted. The methods of the backend
+instance a Meter starts on are wrapped while any Meter is using it, and
+restored once the last one stops. On django 1.7 and later each thread has its
+own instance, so each thread's instance is wrapped separately.
+"""
+
+import logging
+import threading
+from django.conf import settings
+from django.db import connection
+
+authlog = logging.getLogger("auth_mac.authorization")
+
+# The queries each stage should need with the database nonce store
+DEFAULT_BUDGET = {
+  "header": 0,
+  "host": 0,
+  "credentials": 1,
+  "nonce": 2,
+  "signature": 0,
+  "user": 1,
+}
+# Nothing in the authentication path should touch the cache
+DEFAULT_CACHE_BUDGET = dict((x, 0) for x in DEFAULT_BUDGET)
+
+class QueryBudgetExceeded(Exception):
+  pass
+
+_local = threading.local()
+
+def _count_cache_call():
+  "Count a cache call against the stage currently being metered, if any"
+  counts = getattr(_local, "cache_calls", None)
+  if counts is not None:
+    counts[0] += 1
+
+CACHE_METHODS = ("get", "set", "add", "delete", "get_many", "set_many",
+                 "delete_many", "has_key", "incr", "decr")
+
+# The wrapped cache instances: id -> [instance, meters using it, originals]
+_wrapped_caches = {}
+_cache_lock = threading.Lock()
+
+def _default_cache():
+  "Returns the default cache backend instance used by this thread"
+  try:
+    from django.core.cache import caches, DEFAULT_CACHE_ALIAS
+  except ImportError:
+    # Before django 1.7 there is a single, shared instance
+    from django.core.cache import cache
+    return cache
+  return caches[DEFAULT_CACHE_ALIAS]
+
+def _instrument_cache():
+  """Wrap the default cache, so that calls made during a stage are counted.
+  Returns the instance that was wrapped, to hand back to _restore_cache"""
+  cache = _default_cache()
+  with _cache_lock:
+    entry = _wrapped_caches.get(id(cache))
+    if entry is not None:
+      entry[1] += 1
+      return cache
+    def counted(method):
+      def wrapper(*args, **kwargs):
+        _count_cache_call()
+        return method(*args, **kwargs)
+      return wrapper
+    originals = {}
+    for name in CACHE_METHODS:
+      if hasattr(cache, name):
+        # Remember whether the instance had its own attribute to restore
+        originals[name] = cache.__dict__.get(name)
+        setattr(cache, name, counted(getattr(cache, name)))
+    _wrapped_caches[id(cache)] = [cache, 1, originals]
+  return cache
+
+def _restore_cache(cache):
+  "Remove the wrappers from a cache instance once no meter is using it"
+  with _cache_lock:
+    entry = _wrapped_caches[id(cache)]
+    entry[1] -= 1
+    if entry[1] > 0:
+      return
+    for name, original in entry[2].items():
+      if original is None:
+        delattr(cache, name)
+      else:
+        setattr(cache, name, original)
+    del _wrapped_caches[id(cache)]
+
+class Meter(object):
+  "Counts the queries and cache calls made by each stage of an authentication"
+
+  def __init__(self, budget, cache_budget, action="raise"):
+    self.budget = budget
+    self.cache_budget = cache_budget
+    self.action = action
+    self.queries = {}
+    self.cache_calls = {}
+    self.sql = {}
+    self._cache = None
+
+  def start(self):
+    "Start counting calls to the default cache"
+    self._cache = _instrument_cache()
+
+  def stop(self):
+    "Stop counting calls to the default cache"
+    if self._cache is not None:
+      _restore_cache(self._cache)
+      self._cache = None
+
+  def run(self, stage, check):
+    "Run a stage, counting the queries and cache calls it makes"
+    debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    first_query = len(connection.queries)
+    _local.cache_calls = [0]
+    try:
+      return check()
+    finally:
+      stage_sql = [x["sql"] for x in connection.queries[first_query:]]
+      self.sql[stage] = self.sql.get(stage, []) + stage_sql
+      self.queries[stage] = self.queries.get(stage, 0) + len(stage_sql)
+      self.cache_calls[stage] = self.cache_calls.get(stage, 0) + _local.cache_calls[0]
+      _local.cache_calls = None
+      connection.use_debug_cursor = debug_cursor
+
+  def overruns(self):
+    "Returns a list of (stage, kind, used, allowed) for every exceeded budget"
+    overruns = []
+    for stage, used in sorted(self.queries.items()):
+      if used > self.budget.get(stage, 0):
+        overruns.append((stage, "queries", used, self.budget.get(stage, 0)))
+    for stage, used in sorted(self.cache_calls.items()):
+      if used > self.cache_budget.get(stage, 0):
+        overruns.append((stage, "cache calls", used, self.cache_budget.get(stage, 0)))
+    return overruns
+
+  def report(self):
+    "A readable breakdown of usage by stage"
+    lines = []
+    for stage in sorted(self.queries):
+      lines.append("{0}: {1} queries, {2} cache calls".format(
+        stage, self.queries[stage], self.cache_calls[stage]))
+      lines.extend("  " + sql for sql in self.sql[stage])
+    return "\n".join(lines)
+
+  def enforce(self):
+    "Raise or log if any stage went over budget"
+    overruns = self.overruns()
+    if not overruns:
+      return
+    summary = ", ".join("{0} used {2} {1} (budget {3})".format(*x) for x in overruns)
+    if self.action == "log":
+      authlog.warning("MAC authentication over budget: %s\n%s", summary, self.report())
+    else:
+      raise QueryBudgetExceeded("{0}\n{1}".format(summary, self.report()))
+
+def get_meter():
+  "Returns a new Meter if budget enforcement is switched on, else None"
+  budget = getattr(settings, "AUTH_MAC_QUERY_BUDGET", None)
+  if not budget:
+    return None
+  query_budget = dict(DEFAULT_BUDGET)
+  if isinstance(budget, dict):
+    query_budget.update(budget)
+  cache_budget = dict(DEFAULT_CACHE_BUDGET)
+  cache_budget.update(getattr(settings, "AUTH_MAC_CACHE_BUDGET", {}))
+  return Meter(query_budget, cache_budget,
+               getattr(settings, "AUTH_MAC_QUERY_BUDGET_ACTION", "raise"))
@@ -1,14 +1,28 @@
 import logging
+import time
 from functools import wraps
 from django.contrib.auth.models import AnonymousUser
 from django.http import HttpResponse
 
 from auth_mac.models import Nonce, Credentials
 from auth_mac.tools import Validator
+from auth_mac.events import record_event
 
 # Get an instance of a logger
 authlog = logging.getLogger("auth_mac.authorization")
 
+def _validate(request):
+  "Validate the request credentials, recording the outcome as an event"
+  authstr = request.META["HTTP_AUTHORIZATION"]
+  authlog.debug("Recieved Auth Request: %s", authstr)
+  start = time.time()
+  v = Validator(authstr, request)
+  valid = v.validate()
+  identifier = getattr(v, "data", {}).get("id")
+  record_event(identifier, "success" if valid else "failure",
+               error=v.error, stage=v.stage, latency=time.time() - start)
+  return valid, v
+
 def require_credentials(f):
   @wraps(f)
   def wrapper(request, *args, **kwargs):
@@ -18,23 +32,19 @@ def require_credentials(f):
       response['WWW-Authenticate'] =  'MAC'
       return response
     # Build the validation object
-    authstr = request.META["HTTP_AUTHORIZATION"]
-    authlog.debug("Recieved Auth Request: {0}".format(authstr))
-    v = Validator(authstr, request)
-    if not v.validate():
+    valid, v = _validate(request)
+    if not valid:
       response = HttpResponse(status=401)
       if v.error:
         response['WWW-Authenticate'] =  'MAC error="{0}"'.format(v.error)
-        authlog.warning("Failed MAC Authentication: {0}".format(v.error))
       else:
         response['WWW-Authenticate'] =  'MAC'
       if v.errorBody:
         response.content = v.errorBody
-        authlog.warning("Attached HTTP Body: {0}".format(repr(v.errorBody)))
+        authlog.debug("Attached HTTP Body: %r", v.errorBody)
       return response
     # It validated, use the user
     request.user = v.user
-    authlog.info("Validated credentials for user {0}".format(v.user.username))
 
     return f(request, *args, **kwargs)
   return wrapper
@@ -44,10 +54,9 @@ def read_credentials(f):
   def wrapper(request, *args, **kwargs):
     """pull the credentials out of the request, and use them if valid"""
     if request.META.has_key("HTTP_AUTHORIZATION"):
-      authstr = request.META["HTTP_AUTHORIZATION"]
-      v = Validator(authstr, request)
-      if v.validate():
+      valid, v = _validate(request)
+      if valid:
         request.user = v.user
     # Now, call the wrapped function regardless
     return f(request, *args, **kwargs)
-  return wrapper
\ No newline at end of file
+  return wrapper
@@ -0,0 +1,185 @@
+"""
+Buffered recording of authentication events.
+
+Each authentication attempt made through the decorators is turned into an
+AuthEvent and placed on a bounded queue. A background thread takes events off
+the queue and hands them to a writer in batches, so that formatting and output
+never happen on the request thread. If the queue fills up, new events are
+dropped and counted rather than blocking the request; the writer thread logs
+a warning with the number of events lost. Anything still queued when the
+process exits is flushed, and a sink inherited across a fork restarts its
+writer thread in the child.
+
+The sink is configured through the django settings:
+
+  AUTH_MAC_EVENTS              -- Set to False to disable event recording
+  AUTH_MAC_EVENT_WRITER        -- Dotted path to a callable taking a list of
+                                  events. Defaults to log_writer.
+  AUTH_MAC_EVENT_BUFFER        -- Maximum number of queued events (1000)
+  AUTH_MAC_EVENT_BATCH         -- Maximum events per writer call (100)
+  AUTH_MAC_EVENT_INTERVAL      -- Seconds to wait for a batch to fill (1.0)
+"""
+
+import os
+import atexit
+import logging
+import threading
+import time
+import Queue
+from django.conf import settings
+
+authlog = logging.getLogger("auth_mac.authorization")
+
+class AuthEvent(object):
+  "A single authentication attempt, and how it turned out"
+  __slots__ = ("identifier", "outcome", "error", "stage", "latency", "time")
+
+  def __init__(self, identifier, outcome, error=None, stage=None, latency=None):
+    self.identifier = identifier
+    self.outcome = outcome
+    self.error = error
+    self.stage = stage
+    self.latency = latency
+    self.time = time.time()
+
+  @property
+  def succeeded(self):
+    return self.outcome == "success"
+
+  def __unicode__(self):
+    return u"{0} id={1} stage={2} error={3} latency={4:.2f}ms".format(
+      self.outcome, self.identifier, self.stage, self.error,
+      (self.latency or 0) * 1000)
+
+  def __str__(self):
+    return unicode(self).encode("utf-8")
+
+def log_writer(events):
+  "Writes a batch of events to the auth_mac.authorization log"
+  for event in events:
+    if event.succeeded:
+      authlog.info("MAC authentication %s", event)
+    else:
+      authlog.warning("MAC authentication %s", event)
+
+class EventSink(object):
+  "Buffers authentication events and writes them out from a background thread"
+
+  def __init__(self, writer=log_writer, maxsize=1000, batch_size=100, interval=1.0):
+    self.writer = writer
+    self.batch_size = batch_size
+    self.interval = interval
+    self.queue = Queue.Queue(maxsize)
+    self.dropped = 0
+    self._reported_drops = 0
+    self._lock = threading.Lock()
+    self._thread = None
+    self._pid = None
+
+  def record(self, event):
+    "Queue an event for writing. Never blocks; drops the event if full"
+    try:
+      self.queue.put_nowait(event)
+    except Queue.Full:
+      with self._lock:
+        self.dropped += 1
+      return False
+    return True
+
+  def start(self):
+    "Start the background writer thread, if it isn't already running"
+    with self._lock:
+      # A thread started before a fork does not exist in the child
+      if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+        return
+      self._pid = os.getpid()
+      self._thread = threading.Thread(target=self._run, name="auth_mac-events")
+      self._thread.daemon = True
+      self._thread.start()
+
+  @property
+  def forked(self):
+    "Whether the writer thread was started in a different process"
+    return self._thread is not None and self._pid != os.getpid()
+
+  def _next_batch(self, timeout):
+    "Wait for up to a batch of events to arrive"
+    batch = []
+    try:
+      batch.append(self.queue.get(timeout=timeout))
+      while len(batch) < self.batch_size:
+        batch.append(self.queue.get_nowait())
+    except Queue.Empty:
+      pass
+    return batch
+
+  def _write(self, batch):
+    try:
+      self.writer(batch)
+    except Exception:
+      # The writer must never take the thread down with it
+      authlog.exception("Failed writing %d authentication events", len(batch))
+
+  def _report_drops(self):
+    "Warn about any events dropped since the last report"
+    with self._lock:
+      dropped = self.dropped - self._reported_drops
+      self._reported_drops = self.dropped
+    if dropped:
+      authlog.warning("Dropped %d authentication events; the event buffer was full", dropped)
+
+  def _run(self):
+    while True:
+      batch = self._next_batch(self.interval)
+      if batch:
+        self._write(batch)
+      self._report_drops()
+
+  def flush(self):
+    "Synchronously write out everything currently queued"
+    while True:
+      batch = self._next_batch(0)
+      if not batch:
+        break
+      self._write(batch)
+    self._report_drops()
+
+_sink = None
+_sink_lock = threading.Lock()
+
+def _import_writer(path):
+  module, name = path.rsplit(".", 1)
+  return getattr(__import__(module, {}, {}, [name]), name)
+
+def _flush_at_exit():
+  "Write out any events still queued, as the writer thread is about to die"
+  if _sink is not None:
+    _sink.flush()
+
+def get_sink():
+  "Returns the configured, running event sink, or None if disabled"
+  global _sink
+  if not getattr(settings, "AUTH_MAC_EVENTS", True):
+    return None
+  if _sink is None:
+    with _sink_lock:
+      if _sink is None:
+        writer = getattr(settings, "AUTH_MAC_EVENT_WRITER", None)
+        sink = EventSink(
+          writer=_import_writer(writer) if writer else log_writer,
+          maxsize=getattr(settings, "AUTH_MAC_EVENT_BUFFER", 1000),
+          batch_size=getattr(settings, "AUTH_MAC_EVENT_BATCH", 100),
+          interval=getattr(settings, "AUTH_MAC_EVENT_INTERVAL", 1.0))
+        sink.start()
+        _sink = sink
+        atexit.register(_flush_at_exit)
+  elif _sink.forked:
+    _sink.start()
+  return _sink
+
+def record_event(identifier, outcome, error=None, stage=None, latency=None):
+  "Record an authentication event with the configured sink"
+  sink = get_sink()
+  if sink is None:
+    return False
+  return sink.record(AuthEvent(identifier, outcome, error, stage, latency))
@@ -0,0 +1,289 @@
+"""
+A load and replay-correctness harness for the auth_mac decorators.
+
+Drives the protected and optional views in auth_mac.tests.urls, and so both
+require_credentials and read_credentials, from a number of threads and
+processes with a mixture of fresh, replayed, forged and expired requests, all
+signed with Signature.get_header. Afterwards it reports the throughput,
+latency percentiles, the number of database queries per request, and any
+request that was accepted when it should not have been - in particular any
+replayed request.
+
+It can be run standalone against an in-memory or file SQLite database:
+
+  python -m auth_mac.loadtest --requests=2000 --threads=8
+  python -m auth_mac.loadtest --database=/tmp/load.db --processes=4 --threads=4
+
+An in-memory database is private to its connection, so it can only be driven
+by a single thread. Use a database file to test concurrency.
+"""
+
+import sys
+import json
+import time
+import random
+import threading
+import multiprocessing
+from optparse import OptionParser
+
+# The default mixture of requests to send
+DEFAULT_MIX = {"fresh": 0.6, "replay": 0.2, "forged": 0.1, "expired": 0.1}
+# The views to send them to. Both answer with the username when authenticated
+VIEWS = ("/protected_resource", "/optional_resource")
+USERNAME = "loadtest"
+
+def configure(database=":memory:"):
+  "Configure a standalone django environment, and create the tables"
+  from django.conf import settings
+  if not settings.configured:
+    settings.configure(
+      DATABASES={"default": {"ENGINE": "django.db.backends.sqlite3",
+                             "NAME": database}},
+      INSTALLED_APPS=["django.contrib.auth", "django.contrib.contenttypes",
+                      "auth_mac"],
+      ROOT_URLCONF="auth_mac.tests.urls",
+    )
+  from django.core.management import call_command
+  call_command("syncdb", interactive=False, verbosity=0)
+
+def create_credentials():
+  "Returns a valid and an expired set of credentials to test with"
+  import datetime
+  from django.contrib.auth.models import User
+  from auth_mac.models import Credentials
+  from auth_mac.utils import utcnow
+  user, created = User.objects.get_or_create(username=USERNAME)
+  valid, created = Credentials.objects.get_or_create(user=user,
+    identifier="loadtestvalid", defaults={"key": "loadtestkey"})
+  expired, created = Credentials.objects.get_or_create(user=user,
+    identifier="loadtestexpire", defaults={"key": "loadtestkey"})
+  # Always make sure these are current
+  valid.expiry = utcnow() + datetime.timedelta(days=1)
+  valid.save()
+  expired.expiry = utcnow() - datetime.timedelta(days=1)
+  expired.save()
+  return valid, expired
+
+class _ForgedCredentials(object):
+  "A real identifier, but the wrong key"
+  def __init__(self, identifier):
+    self.identifier = identifier
+    self.key = "NOTTHERIGHTKEY"
+
+def _choose_kind(mix):
+  "Pick a kind of request at random, weighted by the mix"
+  point = random.uniform(0, sum(mix.values()))
+  for kind, weight in sorted(mix.items()):
+    point -= weight
+    if point < 0:
+      break
+  return kind
+
+def build_plan(valid, expired, requests, mix=DEFAULT_MIX):
+  """Build a shuffled list of (key, kind, path, header) requests to send.
+
+  Every replay reuses the header of a fresh request, and shares its key; no
+  more than one request with any key should ever be accepted."""
+  from auth_mac.tools import Signature
+  forged = _ForgedCredentials(valid.identifier)
+  plan = []
+  fresh = []
+  for index in range(requests):
+    kind = _choose_kind(mix)
+    if kind == "replay" and not fresh:
+      kind = "fresh"
+    path = random.choice(VIEWS)
+    params = dict(method="GET", port=80, host="example.com", uri=path)
+    if kind == "fresh":
+      header = Signature(valid, **params).get_header()
+      fresh.append((index, path, header))
+      plan.append((index, kind, path, header))
+    elif kind == "replay":
+      key, path, header = random.choice(fresh)
+      plan.append((key, kind, path, header))
+    elif kind == "forged":
+      plan.append((index, kind, path, Signature(forged, **params).get_header()))
+    elif kind == "expired":
+      plan.append((index, kind, path, Signature(expired, **params).get_header()))
+  random.shuffle(plan)
+  return plan
+
+def _send_requests(plan):
+  "Send a list of requests, one after another, and time them"
+  from django.db import connection
+  from django.test.client import Client
+  # Record queries regardless of the DEBUG setting
+  debug_cursor = connection.use_debug_cursor
+  connection.use_debug_cursor = True
+  client = Client()
+  results = []
+  try:
+    for key, kind, path, header in plan:
+      error = None
+      accepted = False
+      start = time.time()
+      try:
+        response = client.get(path,
+          HTTP_AUTHORIZATION=header, HTTP_HOST="example.com")
+        # The optional view answers 200 either way; only the body says who we are
+        accepted = response.status_code == 200 and response.content == USERNAME
+      except Exception as e:
+        error = "{0}: {1}".format(type(e).__name__, e)
+      latency = time.time() - start
+      # The query log is reset at the start of every request
+      results.append((key, kind, path, accepted, latency, len(connection.queries), error))
+  finally:
+    connection.use_debug_cursor = debug_cursor
+  return results
+
+def _send_threaded(plan, threads):
+  "Split a list of requests over several threads"
+  if threads <= 1:
+    return _send_requests(plan)
+  results = []
+  lock = threading.Lock()
+  def worker(part):
+    from django.db import connection
+    try:
+      part_results = _send_requests(part)
+    finally:
+      connection.close()
+    with lock:
+      results.extend(part_results)
+  workers = [threading.Thread(target=worker, args=(plan[i::threads],))
+             for i in range(threads)]
+  for thread in workers:
+    thread.start()
+  for thread in workers:
+    thread.join()
+  return results
+
+def _process_worker(args):
+  plan, threads = args
+  return _send_threaded(plan, threads)
+
+def percentile(values, fraction):
+  "Returns the value at a fraction of the way through the sorted values"
+  if not values:
+    return None
+  values = sorted(values)
+  return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def is_lock_error(error):
+  "Whether an error was SQLite refusing a write under contention"
+  return "database is locked" in error
+
+def analyse(results, elapsed):
+  "Summarise a list of request results"
+  latencies = [x[4] for x in results]
+  queries = [x[5] for x in results if x[6] is None]
+  report = {
+    "requests": len(results),
+    "elapsed": elapsed,
+    "throughput": len(results) / elapsed if elapsed else None,
+    "latency": dict((name, percentile(latencies, f))
+                    for name, f in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1.0))),
+    "queries_mean": float(sum(queries)) / len(queries) if queries else None,
+    "queries_max": max(queries) if queries else None,
+    "errors": [x[6] for x in results if x[6]],
+    "lock_errors": len([x for x in results if x[6] and is_lock_error(x[6])]),
+    "kinds": {},
+    "views": {},
+  }
+  accepted = {}
+  for key, kind, path, was_accepted, latency, query_count, error in results:
+    for name, group in ((kind, report["kinds"]), (path, report["views"])):
+      counts = group.setdefault(name, {"sent": 0, "accepted": 0})
+      counts["sent"] += 1
+      counts["accepted"] += was_accepted
+    if was_accepted:
+      accepted[key] = accepted.get(key, 0) + 1
+  # Only one request per key should ever get through
+  report["replays_accepted"] = sum(x - 1 for x in accepted.values() if x > 1)
+  report["forgeries_accepted"] = sum(report["kinds"].get(x, {}).get("accepted", 0)
+                                     for x in ("forged", "expired"))
+  return report
+
+def run(requests=1000, threads=1, processes=1, mix=DEFAULT_MIX, database=None):
+  """Send a mixture of requests to the test views, and report on them.
+
+  Expects django to be configured with auth_mac.tests.urls as the url conf,
+  unless a standalone database is given, in which case it is configured."""
+  if database is not None:
+    configure(database)
+  from django.conf import settings
+  from django.db import connection
+  if (threads > 1 or processes > 1) and \
+      settings.DATABASES["default"]["NAME"] in ("", ":memory:"):
+    raise ValueError("An in-memory database can only be used by one thread")
+  valid, expired = create_credentials()
+  plan = build_plan(valid, expired, requests, mix)
+
+  start = time.time()
+  if processes > 1:
+    # Don't share the parent connection with the children
+    connection.close()
+    pool = multiprocessing.Pool(processes)
+    try:
+      parts = pool.map(_process_worker,
+                       [(plan[i::processes], threads) for i in range(processes)])
+    finally:
+      pool.close()
+      pool.join()
+    results = [x for part in parts for x in part]
+  else:
+    results = _send_threaded(plan, threads)
+  return analyse(results, time.time() - start)
+
+def _format_ms(seconds):
+  if seconds is None:
+    return "n/a"
+  return "{0:.2f}ms".format(seconds * 1000)
+
+def format_report(report):
+  lines = [
+    "Requests:    {0} in {1:.2f}s ({2:.1f}/s)".format(
+      report["requests"], report["elapsed"], report["throughput"] or 0),
+    "Latency:     " + ", ".join("{0}={1}".format(x, _format_ms(report["latency"][x]))
+                                for x in ("p50", "p90", "p99", "max")),
+    "Queries:     {0:.2f} per request (max {1})".format(
+      report["queries_mean"] or 0, report["queries_max"]),
+  ]
+  for group in ("kinds", "views"):
+    for name, counts in sorted(report[group].items()):
+      lines.append("  {0:<20} {1[sent]} sent, {1[accepted]} accepted".format(name, counts))
+  lines.append("Errors:      {0} ({1} database is locked)".format(
+    len(report["errors"]), report["lock_errors"]))
+  for error in sorted(set(report["errors"])):
+    lines.append("  " + error)
+  lines.append("Wrongly accepted replays:  {0}".format(report["replays_accepted"]))
+  lines.append("Wrongly accepted forgeries: {0}".format(report["forgeries_accepted"]))
+  return "\n".join(lines)
+
+def main(argv=None):
+  parser = OptionParser(usage="%prog [options]")
+  parser.add_option("--database", default=":memory:",
+                    help="SQLite database file to use [default: in-memory]")
+  parser.add_option("--requests", type="int", default=1000)
+  parser.add_option("--threads", type="int", default=1,
+                    help="Threads per process")
+  parser.add_option("--processes", type="int", default=1)
+  parser.add_option("--json", action="store_true", default=False,
+                    help="Print the report as JSON")
+  options, args = parser.parse_args(argv)
+  try:
+    report = run(options.requests, options.threads, options.processes,
+                 database=options.database)
+  except ValueError as e:
+    parser.error(str(e))
+  if options.json:
+    print(json.dumps(report))
+  else:
+    print(format_report(report))
+  # Signal failure if anything got through that shouldn't have
+  if report["replays_accepted"] or report["forgeries_accepted"]:
+    return 1
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -2,14 +2,38 @@
 This module tests the auth_mac package
 """
 
+import django
 from django.test import TestCase
-from django.test.client import Client
+from django.test.client import Client, RequestFactory
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+try:
+  from django.test.utils import override_settings
+except ImportError:
+  # Only available from django 1.4
+  override_settings = None
 from django.contrib.auth.models import User
 from auth_mac.models import Credentials, Nonce
 import datetime
+import logging
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
 import hmac, hashlib, base64
 import unittest
-from auth_mac.tools import Signature, to_utc
+from auth_mac.tools import Signature, Validator, to_utc
+from auth_mac.tools import (split_host, host_allowed, get_host_context,
+  clear_host_contexts, HOST_CONTEXT_CACHE_SIZE)
+from auth_mac import events
+from auth_mac.events import EventSink, AuthEvent, log_writer
+from auth_mac import loadtest
+from auth_mac import budget
+from auth_mac.budget import (get_meter, QueryBudgetExceeded,
+  DEFAULT_BUDGET, DEFAULT_CACHE_BUDGET)
 
 class Test_NoAuthorisation(TestCase):
   urls = "auth_mac.tests.urls"
@@ -272,3 +296,423 @@ class TestTimestamps(TestCase):
   
   def test_offsetregistration(self):
     "Test that using credentials fixes the associated clock offset"
+
+
+class TestEvents(TestCase):
+  "Tests the buffered authentication event sink"
+  urls = "auth_mac.tests.urls"
+
+  def setUp(self):
+    self.written = []
+    self.sink = EventSink(writer=self.written.extend, maxsize=3, batch_size=2)
+
+  def test_batched_write(self):
+    "Test that queued events are written out in batches on flush"
+    batches = []
+    self.sink.writer = batches.append
+    for i in range(3):
+      self.sink.record(AuthEvent("id{0}".format(i), "failure", stage="credentials"))
+    self.assertEqual(batches, [])
+    self.sink.flush()
+    self.assertEqual([len(x) for x in batches], [2, 1])
+    self.assertEqual(batches[0][0].identifier, "id0")
+
+  def test_overload_drops(self):
+    "Test that a full buffer drops and counts events rather than blocking"
+    for i in range(5):
+      self.sink.record(AuthEvent("id", "failure"))
+    self.assertEqual(self.sink.dropped, 2)
+    self.sink.flush()
+    self.assertEqual(len(self.written), 3)
+
+  def test_failing_writer(self):
+    "Test that an exception in the writer does not escape the sink"
+    def broken(events):
+      raise IOError("Disk full")
+    self.sink.writer = broken
+    self.sink.record(AuthEvent("id", "failure"))
+    self.sink.flush()
+    self.assertTrue(self.sink.queue.empty())
+
+  def test_failure_stage(self):
+    "Test that a validator records the stage at which it failed"
+    user = User.objects.create_user("testuser", "test@test.com")
+    credentials = Credentials(user=user, identifier="h480djs93hd8", key="489dks293j39")
+    credentials.save()
+    class CredShell(object):
+      key = "NOTAVALIDKEY"
+      identifier = "NOTANIDENTIFIER"
+    s = Signature(CredShell(), method="GET", port=80, host="example.com", uri="/protected_resource")
+    request = RequestFactory().get("/protected_resource", HTTP_HOST="example.com")
+    v = Validator(s.get_header(), request)
+    self.assertFalse(v.validate())
+    self.assertEqual(v.stage, "credentials")
+
+class TestEventLogging(TestCase):
+  "Tests the events recorded by the decorators, and how they are logged"
+  urls = "auth_mac.tests.urls"
+
+  def setUp(self):
+    self.user = User.objects.create_user("testuser", "test@test.com")
+    self.rfc_credentials = Credentials(user=self.user, identifier="h480djs93hd8", key="489dks293j39")
+    self.rfc_credentials.save()
+    self.written = []
+    self.original_sink = events._sink
+    events._sink = EventSink(writer=self.written.extend)
+    # Capture what reaches the authorization log
+    self.logged = []
+    self.handler = logging.Handler()
+    self.handler.emit = lambda record: self.logged.append(record.getMessage())
+    self.logger = logging.getLogger("auth_mac.authorization")
+    self.logger.addHandler(self.handler)
+    self.level = self.logger.level
+    self.logger.setLevel(logging.DEBUG)
+
+  def tearDown(self):
+    events._sink = self.original_sink
+    self.logger.removeHandler(self.handler)
+    self.logger.setLevel(self.level)
+
+  def test_decorator_events(self):
+    "Test that both decorators record the outcome and stage of each request"
+    s = Signature(self.rfc_credentials, method="GET", port=80, host="example.com", uri="/protected_resource")
+    c = Client()
+    c.get("/protected_resource", HTTP_AUTHORIZATION=s.get_header(), HTTP_HOST="example.com")
+    bad = 'MAC nonce="djd3hs9s", mac="INVALIDSIGNATURE=", id="h480djs93hd8", ts="1336363200"'
+    c.get("/optional_resource", HTTP_AUTHORIZATION=bad, HTTP_HOST="example.com")
+    events._sink.flush()
+    self.assertEqual([(x.identifier, x.outcome, x.stage) for x in self.written],
+                     [("h480djs93hd8", "success", "user"),
+                      ("h480djs93hd8", "failure", "signature")])
+    self.assertEqual(self.written[1].error, "Invalid Signature. Base string in body.")
+
+  def test_log_writer(self):
+    "Test that the default writer logs the event details"
+    log_writer([AuthEvent("h480djs93hd8", "failure", error="Duplicate nonce",
+                          stage="nonce", latency=0.0021)])
+    self.assertEqual(self.logged, ["MAC authentication failure id=h480djs93hd8 "
+                                   "stage=nonce error=Duplicate nonce latency=2.10ms"])
+
+  def test_drops_reported(self):
+    "Test that dropped events are reported in the log"
+    sink = EventSink(writer=self.written.extend, maxsize=1)
+    for i in range(4):
+      sink.record(AuthEvent("id", "failure"))
+    sink.flush()
+    self.assertIn("Dropped 3 authentication events; the event buffer was full", self.logged)
+    # Only new drops get reported
+    del self.logged[:]
+    sink.flush()
+    self.assertEqual(self.logged, [])
+
+  def test_restart_after_fork(self):
+    "Test that a sink inherited by a forked process restarts its writer"
+    sink = events._sink
+    sink.start()
+    self.assertFalse(sink.forked)
+    # Pretend the thread was started by our parent process
+    sink._pid = -1
+    self.assertTrue(sink.forked)
+    self.assertIs(events.get_sink(), sink)
+    self.assertFalse(sink.forked)
+    self.assertTrue(sink._thread.is_alive())
+
+  def test_flush_at_exit(self):
+    "Test that queued events are written out at exit"
+    events._sink.record(AuthEvent("h480djs93hd8", "failure"))
+    events._flush_at_exit()
+    self.assertEqual(len(self.written), 1)
+
+class TestLoad(TestCase):
+  "Runs small passes of the load harness"
+  urls = "auth_mac.tests.urls"
+
+  def test_replays_refused(self):
+    "Test that no replayed or forged request is accepted under the harness"
+    debug_cursor = connection.use_debug_cursor
+    report = loadtest.run(requests=60)
+    self.assertEqual(connection.use_debug_cursor, debug_cursor)
+    self.assertEqual(report["requests"], 60)
+    self.assertEqual(report["errors"], [])
+    self.assertEqual(report["replays_accepted"], 0)
+    self.assertEqual(report["forgeries_accepted"], 0)
+    self.assertEqual(sorted(report["views"]), sorted(loadtest.VIEWS))
+
+  def test_empty_report(self):
+    "Test that a report can be made with no requests"
+    report = loadtest.analyse([], 0)
+    self.assertIn("p50=n/a", loadtest.format_report(report))
+
+  def test_concurrent_file_database(self):
+    "Runs the harness from several processes and threads against a database file"
+    directory = tempfile.mkdtemp()
+    try:
+      env = dict(os.environ)
+      env.pop("DJANGO_SETTINGS_MODULE", None)
+      package_root = os.path.dirname(os.path.dirname(loadtest.__file__))
+      env["PYTHONPATH"] = os.pathsep.join(filter(None, [package_root, env.get("PYTHONPATH")]))
+      process = subprocess.Popen([sys.executable, "-m", "auth_mac.loadtest",
+        "--database=" + os.path.join(directory, "load.db"),
+        "--requests=80", "--threads=4", "--processes=2", "--json"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+      output, errors = process.communicate()
+    finally:
+      shutil.rmtree(directory)
+    # A crash leaves a traceback, and no report, rather than a status of 1
+    try:
+      report = json.loads(output)
+    except ValueError:
+      self.fail("The harness did not produce a report:\n" + output + errors)
+    self.assertEqual(report["requests"], 80)
+    # SQLite refusing writes under contention is expected; anything else isn't
+    self.assertEqual([x for x in report["errors"] if not loadtest.is_lock_error(x)], [])
+    self.assertEqual(report["replays_accepted"], 0)
+    self.assertEqual(report["forgeries_accepted"], 0)
+    self.assertEqual(process.returncode, 0, errors)
+
+class TestQueryBudget(TestCase):
+  "Tests the per-stage query budgets"
+  urls = "auth_mac.tests.urls"
+
+  def setUp(self):
+    self.user = User.objects.create_user("testuser", "test@test.com")
+    self.rfc_credentials = Credentials(user=self.user, identifier="h480djs93hd8", key="489dks293j39")
+    self.rfc_credentials.save()
+    self.signature = Signature(self.rfc_credentials, method="GET", port=80, host="example.com", uri="/protected_resource")
+    settings.AUTH_MAC_QUERY_BUDGET = True
+
+  def tearDown(self):
+    for name in ("AUTH_MAC_QUERY_BUDGET", "AUTH_MAC_QUERY_BUDGET_ACTION"):
+      if hasattr(settings, name):
+        delattr(settings, name)
+
+  def _validator(self, header=None):
+    request = RequestFactory().get("/protected_resource", HTTP_HOST="example.com")
+    return Validator(header or self.signature.get_header(), request)
+
+  def test_default_budget(self):
+    "Test that a fresh request uses exactly the default budget"
+    v = self._validator()
+    self.assertTrue(v.validate())
+    self.assertEqual(v.meter.queries, DEFAULT_BUDGET)
+    self.assertEqual(v.meter.cache_calls, DEFAULT_CACHE_BUDGET)
+
+  def test_replay_budget(self):
+    "Test that a replayed nonce is refused within budget, without a write"
+    header = self.signature.get_header()
+    self.assertTrue(self._validator(header).validate())
+    v = self._validator(header)
+    self.assertFalse(v.validate())
+    self.assertEqual(v.meter.queries, {"header": 0, "host": 0, "credentials": 1, "nonce": 1})
+    self.assertEqual(v.meter.overruns(), [])
+
+  def test_decorator_budget(self):
+    "Test that the decorated view authenticates within the default budget"
+    c = Client()
+    response = c.get("/protected_resource",
+                     HTTP_AUTHORIZATION=self.signature.get_header(),
+                     HTTP_HOST="example.com")
+    self.assertEqual(response.status_code, 200)
+
+  def test_exceeded(self):
+    "Test that going over budget raises, with a breakdown by stage"
+    settings.AUTH_MAC_QUERY_BUDGET = {"nonce": 1}
+    v = self._validator()
+    with self.assertRaises(QueryBudgetExceeded) as context:
+      v.validate()
+    self.assertIn("nonce used 2 queries (budget 1)", str(context.exception))
+
+  def test_exceeded_logged(self):
+    "Test that the log action lets an over budget request through"
+    settings.AUTH_MAC_QUERY_BUDGET = {"user": 0}
+    settings.AUTH_MAC_QUERY_BUDGET_ACTION = "log"
+    v = self._validator()
+    self.assertTrue(v.validate())
+    self.assertEqual(v.meter.overruns(), [("user", "queries", 1, 0)])
+
+  def test_cache_calls_counted(self):
+    "Test that cache calls made inside a stage count against its budget"
+    backend = budget._default_cache()
+    original_get = backend.get
+    meter = get_meter()
+    meter.start()
+    try:
+      meter.run("credentials", lambda: cache.get("auth_mac_test"))
+    finally:
+      meter.stop()
+    self.assertEqual(meter.cache_calls["credentials"], 1)
+    self.assertEqual(meter.overruns(), [("credentials", "cache calls", 1, 0)])
+    # The cache should be left as it was found
+    self.assertEqual(backend.get, original_get)
+    self.assertNotIn("get", backend.__dict__)
+
+  @unittest.skipIf(django.VERSION < (1, 7), "The cache backend can only be swapped on django 1.7+")
+  def test_cache_backends(self):
+    "Test the default budgets, and that cache calls are caught, with each cache backend"
+    for backend_path in ("django.core.cache.backends.locmem.LocMemCache",
+                         "django.core.cache.backends.dummy.DummyCache"):
+      with override_settings(CACHES={"default": {"BACKEND": backend_path}}):
+        backend = budget._default_cache()
+        self.assertEqual(type(backend).__name__, backend_path.rsplit(".", 1)[1])
+        # A fresh request and a replay, with the database nonce store
+        header = self.signature.get_header()
+        v = self._validator(header)
+        self.assertTrue(v.validate())
+        self.assertEqual(v.meter.queries, DEFAULT_BUDGET)
+        self.assertEqual(v.meter.cache_calls, DEFAULT_CACHE_BUDGET)
+        v = self._validator(header)
+        self.assertFalse(v.validate())
+        self.assertEqual(v.meter.overruns(), [])
+        # An extra cache call in the auth path would be caught
+        meter = get_meter()
+        meter.start()
+        try:
+          meter.run("nonce", lambda: cache.get("auth_mac_test"))
+        finally:
+          meter.stop()
+        self.assertEqual(meter.overruns(), [("nonce", "cache calls", 1, 0)])
+        self.assertNotIn("get", backend.__dict__)
+
+class TestHosts(TestCase):
+  "Tests the host allow-list and host context handling"
+  urls = "auth_mac.tests.urls"
+
+  def setUp(self):
+    self.user = User.objects.create_user("testuser", "test@test.com")
+    self.rfc_credentials = Credentials(user=self.user, identifier="h480djs93hd8", key="489dks293j39")
+    self.rfc_credentials.save()
+    # Remember the settings we change, so they can be put back exactly
+    self.missing = object()
+    self.original_settings = dict((name, getattr(settings, name, self.missing))
+      for name in ("AUTH_MAC_ALLOWED_HOSTS", "USE_X_FORWARDED_HOST"))
+    settings.USE_X_FORWARDED_HOST = False
+    clear_host_contexts()
+
+  def tearDown(self):
+    for name, value in self.original_settings.items():
+      if value is self.missing:
+        if hasattr(settings, name):
+          delattr(settings, name)
+      else:
+        setattr(settings, name, value)
+    clear_host_contexts()
+
+  def test_split_host(self):
+    "Test splitting the port from host names and IPv6 literals"
+    self.assertEqual(split_host("example.com"), ("example.com", None))
+    self.assertEqual(split_host("example.com:8000"), ("example.com", "8000"))
+    self.assertEqual(split_host("[::1]"), ("[::1]", None))
+    self.assertEqual(split_host("[::1]:8000"), ("[::1]", "8000"))
+    self.assertEqual(split_host("::1"), ("::1", None))
+
+  def test_host_allowed(self):
+    "Test matching hosts against the allow-list"
+    allowed = ["example.com", ".example.org", "[::1]"]
+    self.assertTrue(host_allowed("EXAMPLE.com", allowed))
+    self.assertTrue(host_allowed("example.org", allowed))
+    self.assertTrue(host_allowed("api.example.org", allowed))
+    self.assertTrue(host_allowed("[::1]", allowed))
+    self.assertFalse(host_allowed("badexample.org", allowed))
+    self.assertFalse(host_allowed("example.net", allowed))
+    self.assertTrue(host_allowed("example.net", None))
+
+  def test_context_cached(self):
+    "Test that a host is only processed once"
+    meta = {"HTTP_HOST": "example.com:80", "SERVER_PORT": "80"}
+    context = get_host_context(meta)
+    self.assertEqual((context.host, context.port), ("example.com", "80"))
+    self.assertIs(get_host_context(dict(meta)), context)
+
+  def test_flooded_cache(self):
+    "Test that unknown hosts are not cached, and can't push out known ones"
+    meta = {"HTTP_HOST": "example.com", "SERVER_PORT": "80"}
+    context = get_host_context(meta)
+    settings.AUTH_MAC_ALLOWED_HOSTS = ["example.com"]
+    for i in range(HOST_CONTEXT_CACHE_SIZE * 2):
+      self.assertFalse(get_host_context({"HTTP_HOST": "h{0}.example.net".format(i),
+                                         "SERVER_PORT": "80"}).allowed)
+    self.assertIs(get_host_context(meta), context)
+    # Without an allow-list, a full cache keeps what it has
+    settings.AUTH_MAC_ALLOWED_HOSTS = None
+    for i in range(HOST_CONTEXT_CACHE_SIZE * 2):
+      get_host_context({"HTTP_HOST": "h{0}.example.net".format(i), "SERVER_PORT": "80"})
+    self.assertIs(get_host_context(meta), context)
+
+  @unittest.skipIf(override_settings is None, "override_settings needs django 1.4+")
+  def test_override_settings(self):
+    "Test that changing the allowed hosts with override_settings takes effect"
+    meta = {"HTTP_HOST": "example.com", "SERVER_PORT": "80"}
+    self.assertTrue(get_host_context(meta).allowed)
+    with override_settings(AUTH_MAC_ALLOWED_HOSTS=["example.org"]):
+      self.assertFalse(get_host_context(meta).allowed)
+    self.assertTrue(get_host_context(meta).allowed)
+
+  def test_unknown_host(self):
+    "Test that an unknown host is refused without querying the database"
+    settings.AUTH_MAC_ALLOWED_HOSTS = ["example.com"]
+    s = Signature(self.rfc_credentials, method="GET", port=80, host="example.net", uri="/protected_resource")
+    request = RequestFactory().get("/protected_resource", HTTP_HOST="example.net")
+    v = Validator(s.get_header(), request)
+    with self.assertNumQueries(0):
+      self.assertFalse(v.validate())
+    self.assertEqual(v.stage, "host")
+    self.assertIn("Host", v.error)
+
+  def test_missing_host(self):
+    "Test that a missing host is refused without the database when there is an allow-list"
+    settings.AUTH_MAC_ALLOWED_HOSTS = ["example.com"]
+    s = Signature(self.rfc_credentials, method="GET", port=80, host="example.com", uri="/protected_resource")
+    v = Validator(s.get_header(), RequestFactory().get("/protected_resource"))
+    with self.assertNumQueries(0):
+      self.assertFalse(v.validate())
+    self.assertEqual(v.stage, "host")
+    self.assertIn("Host", v.error)
+
+  def test_signature_without_host_stage(self):
+    "Test that validate_signature works out the host when run on its own"
+    s = Signature(self.rfc_credentials, method="GET", port=80, host="example.com", uri="/protected_resource")
+    request = RequestFactory().get("/protected_resource", HTTP_HOST="example.com")
+    v = Validator(s.get_header(), request)
+    self.assertTrue(v.validate_header())
+    self.assertTrue(v.validate_credentials())
+    self.assertTrue(v.validate_signature())
+
+  def test_allowed_host(self):
+    "Test that a request to an allowed host is validated"
+    settings.AUTH_MAC_ALLOWED_HOSTS = ["example.com"]
+    s = Signature(self.rfc_credentials, method="GET", port=80, host="example.com", uri="/protected_resource")
+    c = Client()
+    response = c.get("/protected_resource", HTTP_AUTHORIZATION=s.get_header(), HTTP_HOST="example.com")
+    self.assertEqual(response.status_code, 200)
+
+  def test_forwarded_host(self):
+    "Test that X-Forwarded-Host is used only when configured to"
+    s = Signature(self.rfc_credentials, method="GET", port=443, host="example.com", uri="/protected_resource")
+    header = s.get_header()
+    c = Client()
+    response = c.get("/protected_resource", HTTP_AUTHORIZATION=header,
+                     HTTP_HOST="backend:8000", HTTP_X_FORWARDED_HOST="example.com:443, proxy")
+    self.assertEqual(response.status_code, 401)
+    settings.USE_X_FORWARDED_HOST = True
+    s.update(nonce=None)
+    response = c.get("/protected_resource", HTTP_AUTHORIZATION=s.get_header(),
+                     HTTP_HOST="backend:8000", HTTP_X_FORWARDED_HOST="example.com:443, proxy")
+    self.assertEqual(response.status_code, 200)
+
+  def test_forwarded_host_without_port(self):
+    "Test the client's port is found when X-Forwarded-Host has no port"
+    settings.USE_X_FORWARDED_HOST = True
+    meta = {"HTTP_HOST": "backend:8000", "SERVER_PORT": "8000",
+            "HTTP_X_FORWARDED_HOST": "example.com"}
+    self.assertEqual(get_host_context(meta).port, "80")
+    meta["HTTP_X_FORWARDED_PROTO"] = "https"
+    self.assertEqual(get_host_context(meta).port, "443")
+    meta["HTTP_X_FORWARDED_PORT"] = "8443"
+    self.assertEqual(get_host_context(meta).port, "8443")
+    # And through the decorator, as nginx would forward it with $host
+    s = Signature(self.rfc_credentials, method="GET", port=443, host="example.com", uri="/protected_resource")
+    c = Client()
+    response = c.get("/protected_resource", HTTP_AUTHORIZATION=s.get_header(),
+                     HTTP_HOST="backend:8000", SERVER_PORT="8000",
+                     HTTP_X_FORWARDED_HOST="example.com", HTTP_X_FORWARDED_PROTO="https")
+    self.assertEqual(response.status_code, 200)
@@ -1,10 +1,12 @@
 import logging
 import datetime
 import hmac, hashlib, base64
+from django.conf import settings
 from django.contrib.auth.models import User
 from auth_mac.models import Credentials, Nonce
 import re
 from auth_mac.utils import to_utc, random_string
+from auth_mac.budget import get_meter
 import random
 
 reHeader = re.compile(r"""(mac|nonce|id|ts|ext)="([^"]+)""")
@@ -130,10 +132,113 @@ class Signature(object):
       data["ext"] = self.data["ext"]
     return _build_authheader("MAC", data)
 
+def split_host(host):
+  "Splits a Host header into (host, port), allowing for IPv6 literals"
+  if host.startswith("["):
+    # An IPv6 literal, e.g. [::1]:8000. Keep the brackets on the host
+    end = host.find("]")
+    if end != -1 and host[end+1:end+2] == ":":
+      return host[:end+1], host[end+2:] or None
+    return host, None
+  if host.count(":") == 1:
+    hostname, port = host.split(":")
+    return hostname, port or None
+  return host, None
+
+def host_allowed(host, allowed_hosts):
+  """Checks a host against a list of allowed hosts. Entries starting with a
+  dot match the domain and all of its subdomains, and "*" matches anything"""
+  if allowed_hosts is None:
+    return True
+  host = host.lower().rstrip(".")
+  for pattern in allowed_hosts:
+    pattern = pattern.lower()
+    if pattern == "*" or pattern == host:
+      return True
+    if pattern.startswith(".") and (host.endswith(pattern) or host == pattern[1:]):
+      return True
+  return False
+
+class HostContext(object):
+  "The normalised host and port that a request was made to"
+  __slots__ = ("host", "port", "allowed")
+
+  def __init__(self, host, port, allowed):
+    self.host = host
+    self.port = port
+    self.allowed = allowed
+
+# Normalised contexts for allowed hosts, keyed on the raw header and port values
+_host_contexts = {}
+HOST_CONTEXT_CACHE_SIZE = 256
+
+def clear_host_contexts():
+  "Forget all cached host contexts, e.g. after changing the allowed hosts"
+  _host_contexts.clear()
+
+def _host_setting_changed(setting, **kwargs):
+  if setting in ("AUTH_MAC_ALLOWED_HOSTS", "USE_X_FORWARDED_HOST"):
+    clear_host_contexts()
+
+# Keep the cache in step with settings changed by override_settings
+try:
+  from django.core.signals import setting_changed
+except ImportError:
+  try:
+    from django.test.signals import setting_changed
+  except ImportError:
+    # Before django 1.4, settings can't be overridden like this
+    setting_changed = None
+if setting_changed is not None:
+  setting_changed.connect(_host_setting_changed)
+
+def get_host_context(meta):
+  """Returns the HostContext for a request's META dictionary, or None if the
+  request did not say which host it was for.
+
+  X-Forwarded-Host is used in place of the Host header when the
+  USE_X_FORWARDED_HOST setting is on. SERVER_PORT is then the port the proxy
+  connected to, so the client's port is taken from X-Forwarded-Host, then
+  X-Forwarded-Port, then the default port for the X-Forwarded-Proto scheme.
+  The results are cached, so each distinct host only needs to be processed
+  once."""
+  forwarded = getattr(settings, "USE_X_FORWARDED_HOST", False) and \
+    meta.get("HTTP_X_FORWARDED_HOST")
+  if forwarded:
+    scheme = meta.get("HTTP_X_FORWARDED_PROTO") or meta.get("wsgi.url_scheme")
+    key = (forwarded, meta.get("HTTP_X_FORWARDED_PORT"), scheme, True)
+  else:
+    key = (meta.get("HTTP_HOST"), meta.get("SERVER_PORT"), False)
+  if not key[0]:
+    return None
+  context = _host_contexts.get(key)
+  if context is None:
+    if forwarded:
+      # Proxies append to the list; the first entry is what the client asked for
+      host, port = split_host(forwarded.split(",")[0].strip())
+      if not port:
+        port = meta.get("HTTP_X_FORWARDED_PORT")
+      if not port:
+        port = "443" if scheme == "https" else "80"
+    else:
+      # Any port in the Host header is ignored in favour of the server port
+      host, port = split_host(key[0])[0], meta.get("SERVER_PORT")
+    context = HostContext(host, port,
+      host_allowed(host, getattr(settings, "AUTH_MAC_ALLOWED_HOSTS", None)))
+    # Rejected hosts are cheap to work out again, so are never cached. Once
+    # full, keep the hosts we have rather than letting a flood of arbitrary
+    # Host headers push them out
+    if context.allowed and len(_host_contexts) < HOST_CONTEXT_CACHE_SIZE:
+      _host_contexts[key] = context
+  return context
+
 class Validator(object):
   """Validates the mac credentials passed in from an HTTP HEADER"""
   error = None
   errorBody = None
+  stage = None
+  meter = None
+  host_context = None
 
   def __init__(self, Authorization, request):
     self.authstring = Authorization
@@ -165,6 +270,21 @@ class Validator(object):
     self.data = data
     return True
 
+  def validate_host(self):
+    "Validates that the request was made to a host that we answer for"
+    self.host_context = get_host_context(self.request.META)
+    if self.host_context is None:
+      # Without an allow-list, a missing host is reported when we come to
+      # check the signature
+      if getattr(settings, "AUTH_MAC_ALLOWED_HOSTS", None) is None:
+        return True
+      self.error = "Missing Host header"
+      return False
+    if not self.host_context.allowed:
+      self.error = "Unknown Host"
+      return False
+    return True
+
   def validate_credentials(self):
     "Validates that the credentials are valid"
     try:
@@ -204,19 +324,15 @@ class Validator(object):
     "Validates that the signature is good"
     s = Signature(self.credentials)
 
-    if not self.request.META.has_key("HTTP_HOST"):
+    if self.host_context is None:
+      self.host_context = get_host_context(self.request.META)
+    if self.host_context is None:
       # We can't calculate a signature without the host
       self.error = "Missing Host header"
       return False
     
-    hostname = self.request.META["HTTP_HOST"]
-    port = self.request.META["SERVER_PORT"]
-    
-    # Strip out the port from hostname, if this has been passed to us
-    if ":" in hostname:
-      hostname = hostname.split(":")[0]
     # Form the rest of the signature
-    s.update(host=hostname, port=port)
+    s.update(host=self.host_context.host, port=self.host_context.port)
     s.update(timestamp=self.data["ts"], nonce=self.data["nonce"])
     s.update(uri=self.request.path)
     s.update(method=self.request.META["REQUEST_METHOD"])
@@ -230,20 +346,46 @@ class Validator(object):
     
     return True
   
-  def validate(self):
-    "Validates that everything is well formed and signed correctly"
+  def validate_user(self):
+    "Fetches the user that the credentials belong to"
+    self.user = self.credentials.user
+    return True
+
+  def _run_stage(self, stage, check):
+    "Run one stage of the validation, metering it if a budget is active"
+    self.stage = stage
+    if self.meter is None:
+      return check()
+    return self.meter.run(stage, check)
+
+  def _validate(self):
     # Validate the forming of the signature, this will fill _data
-    if not self.validate_header():
+    if not self._run_stage("header", self.validate_header):
+      return False
+    # Turn away unknown hosts before touching the database
+    if not self._run_stage("host", self.validate_host):
       return False
     # Validate that the credentials are good and current
-    if not self.validate_credentials():
+    if not self._run_stage("credentials", self.validate_credentials):
       return False
     # Validate that this nonce is not out of date
-    if not self.validate_nonce():
+    if not self._run_stage("nonce", self.validate_nonce):
       return False
     # Now, validate the cryptographic signature..
-    if not self.validate_signature():
+    if not self._run_stage("signature", self.validate_signature):
       return False
     # Everything worked! et our user property
-    self.user = self.credentials.user
-    return True
+    return self._run_stage("user", self.validate_user)
+
+  def validate(self):
+    "Validates that everything is well formed and signed correctly"
+    self.meter = get_meter()
+    if self.meter is None:
+      return self._validate()
+    self.meter.start()
+    try:
+      valid = self._validate()
+    finally:
+      self.meter.stop()
+    self.meter.enforce()
+    return valid